@@ -22,7 +22,7 @@ def evaluate(model: torch.nn.Module, dataloader, noise_scheduler, noise_kind, et
                                                                              imgs, eta, num_inference_steps,
                                                                              start_at_timestep,
                                                                              patch_imgs,
-                                                                             noise_kind)
+                                                                             noise_kind, return_history=False)
 
             anomaly_maps = diff_map_to_anomaly_map(diffmaps, .3)
             eval_scores.update(scores_batch(gts, anomaly_maps))
@@ -1,25 +1,27 @@
 # imports
 import argparse
+import inspect
 import json
 import os
 from dataclasses import dataclass
 
 import torch
+import torch.distributed as dist
 from diffusers import UNet2DModel
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from torchvision import transforms
 
 import utils.anomalies
 from loader.loader import MVTecDataset
 from schedulers.scheduling_ddim import DDIMScheduler
+from utils.attention import set_sdpa_attention
+from utils.distributed import setup_distributed, is_distributed, is_main_process, gather_rows
+from utils.features import EfficientNetEndpoints, FeatureExtractor
 from utils.files import save_args
-from utils.metrics import scores, scores_batch
+from utils.transforms import batch_augmentations, transform_batch
+from utils.metrics import confusion_batch, scores_from_confusion
 from utils.visualize import generate_samples, plot_single_channel_imgs, plot_rgb_imgs, gray_to_rgb, \
     split_into_patches, add_overlay, add_batch_overlay
-from collections import Counter
-from efficientnet_pytorch import EfficientNet
-from torch.nn import functional as F
 @dataclass
 class InferenceArgs:
     num_inference_steps: int
@@ -41,6 +43,9 @@ class InferenceArgs:
     patch_imgs: bool
     run_id: str
     batch_size: int
+    compile: bool
+    bf16: bool
+    extractor_dtype: str
 
 
 def parse_args() -> InferenceArgs:
@@ -85,89 +90,137 @@ def parse_args() -> InferenceArgs:
                         help='If the image size is larger than the models input, split input into multiple patches and stitch it together afterwards.')
     parser.add_argument('--batch_size', type=int, default=64,
                         help='Number of images to process per batch')
+    parser.add_argument('--compile', action='store_true',
+                        help='If set: compile the UNet and the feature extractor with torch.compile (CUDA graphs). Batches are padded to a static batch size.')
+    parser.add_argument('--bf16', action='store_true',
+                        help='If set: run the feature extractor and the UNet with bfloat16 autocast. The scheduler stays in fp32.')
+    parser.add_argument('--extractor_dtype', type=str, default="float32",
+                        choices=["float32", "bfloat16", "float16"],
+                        help='Precision in which the weights of the (frozen) EfficientNet feature extractor are stored and run.')
 
     return InferenceArgs(**vars(parser.parse_args()))
 
 def main(args: InferenceArgs, writer: SummaryWriter):
     # train loop
     print("**** starting inference *****")
-    config_file = open(f"{args.checkpoint_dir}/model_config.json", "r")
-    model_config = json.loads(config_file.read())
-    train_arg_file = open(f"{args.checkpoint_dir}/train_arg_config.json", "r")
-    train_arg_config: dict = json.loads(train_arg_file.read())
-    save_args(args, args.img_dir, "inference_args")
-
-    augmentations = transforms.Compose(
-        [
-            transforms.Resize(model_config["sample_size"],
-                              interpolation=transforms.InterpolationMode.BILINEAR) if not args.patch_imgs else transforms.Lambda(
-                lambda x: x),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ]
-    )
+    with open(f"{args.checkpoint_dir}/model_config.json", "r") as config_file:
+        model_config = json.load(config_file)
+    with open(f"{args.checkpoint_dir}/train_arg_config.json", "r") as train_arg_file:
+        train_arg_config: dict = json.load(train_arg_file)
+    if is_main_process():
+        save_args(args, args.img_dir, "inference_args")
+
+    augmentations = batch_augmentations(model_config["sample_size"] if not args.patch_imgs else None).to(args.device)
 
     def transform_images(imgs):
-        return [augmentations(image.convert("RGB")) for image in imgs]
+        return transform_batch(imgs, augmentations, args.device)
 
     # data loader
     test_data = MVTecDataset(args.dataset_path, False, args.mvtec_item, args.mvtec_item_states,
                              transform_images)
-    test_loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=args.shuffle)
+    # when launched with torchrun every process runs on its own shard of the test set
+    sampler = DistributedSampler(test_data, shuffle=args.shuffle) if is_distributed() else None
+    test_loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=args.shuffle and sampler is None,
+                             sampler=sampler)
 
     # set model, optimizer, scheduler
     model = UNet2DModel(
         **model_config
     )
-
-    model.load_state_dict(torch.load(f"{args.checkpoint_dir}/{args.checkpoint_name}"))
+    set_sdpa_attention(model)
+
+    checkpoint = f"{args.checkpoint_dir}/{args.checkpoint_name}"
+    if "mmap" in inspect.signature(torch.load).parameters:
+        # PyTorch >= 2.1: memory-map the checkpoint and use the loaded tensors directly as parameters
+        model.load_state_dict(torch.load(checkpoint, map_location=args.device, mmap=True), assign=True)
+    else:
+        model.load_state_dict(torch.load(checkpoint, map_location=args.device))
     model.eval()
-    model.to(args.device)
-    feature_extractor = EfficientNet.from_pretrained('efficientnet-b4')
-    feature_extractor.to(args.device)
+    model.to(args.device, memory_format=torch.channels_last)
+    feature_extractor = FeatureExtractor(EfficientNetEndpoints.from_pretrained('efficientnet-b4'),
+                                         dtype=getattr(torch, args.extractor_dtype))
+    feature_extractor.to(args.device, memory_format=torch.channels_last)
     feature_extractor.eval()
-    diffmap_blur = transforms.GaussianBlur(2 * int(4 * 4 + 0.5) +1, 4)
+    to_anomaly_map = utils.anomalies.AnomalyMap(.3, 2 * int(4 * 4 + 0.5) + 1, 4).to(args.device)
+    if args.compile:
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        feature_extractor = torch.compile(feature_extractor, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        to_anomaly_map = torch.compile(to_anomaly_map, mode="reduce-overhead")
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # validate and generate images
         noise_scheduler_inference = DDIMScheduler(args.train_steps, args.start_at_timestep,
                                                   beta_schedule=args.beta_schedule, timestep_spacing="leading",
                                                   reconstruction_weight=args.reconstruction_weight)
         noise_kind = train_arg_config.get("noise_kind", "gaussian")
-        eval_scores = Counter()
+        # per image confusion counts, they stay on the device until all batches are processed
+        confusions = []
+        autocast_args = dict(device_type=torch.device(args.device).type, dtype=torch.bfloat16, enabled=args.bf16)
+        # in eager mode the features of every batch are written into the same fp32 buffer, see FeatureExtractor.forward
+        fea_buffer = None if args.compile else feature_extractor.empty_output(
+            args.batch_size, model_config["in_channels"], device=args.device, memory_format=torch.channels_last)
+
+        if args.compile:
+            # the first calls compile the graphs and capture the cuda graphs, keep that out of the evaluation loop
+            warmup_imgs = torch.zeros((args.batch_size, *test_data[0][0].shape), device=args.device)
+            warmup_imgs = warmup_imgs.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(**autocast_args):
+                for _ in range(3):
+                    model(feature_extractor(warmup_imgs).float(), torch.tensor(args.start_at_timestep, device=args.device))
 
         for i, (imgs, states, gts) in enumerate(test_loader):
-            imgs = imgs.to(args.device)
-            image_features = list(feature_extractor.extract_endpoints(imgs).values())[:-2]
-            for i in range(4):
-                image_features[i] = F.interpolate(image_features[i], size=(32, 32), mode='bilinear')
-            fea_cat = torch.cat(image_features, dim=1)
+            imgs = imgs.to(args.device, memory_format=torch.channels_last)
+            if args.compile and len(imgs) < args.batch_size:
+                # pad the last batch, a different batch size would trigger a recompilation
+                imgs = torch.cat([imgs, imgs.new_zeros((args.batch_size - len(imgs), *imgs.shape[1:]))])
+                imgs = imgs.contiguous(memory_format=torch.channels_last)
             gts = gts.to(args.device)
-            run_inference_step(diffmap_blur, eval_scores, gts, i, fea_cat, model, noise_kind,
-                               noise_scheduler_inference, states, writer, args.eta, args.num_inference_steps,
-                               args.start_at_timestep, args.patch_imgs, args.plt_imgs, args.img_dir)
-
-        for key in eval_scores:
-            eval_scores[key] /= len(test_loader)
-        writer.add_hparams({'category': args.mvtec_item, 'eta': args.eta,
-                            'recon_weight': args.reconstruction_weight, 'states': ','.join(args.mvtec_item_states),
-                            't': args.start_at_timestep, 'num_steps': args.num_inference_steps,
-                            'input_size': model_config["sample_size"], 'patching': args.patch_imgs}, dict(eval_scores),
-                           run_name=f'hp')
-        print(eval_scores)
-
-
-def run_inference_step(diffmap_blur, eval_scores, gts, btc_idx, imgs, model, noise_kind, noise_scheduler_inference,
+            with torch.autocast(**autocast_args):
+                # the features are the starting point of the diffusion process, keep them (and the scheduler) in fp32
+                fea_out = None if fea_buffer is None else fea_buffer[:len(imgs)]
+                fea_cat = feature_extractor(imgs, fea_out).float()
+                if args.compile:
+                    # the compiled extractor returns a cuda graph output, the unet replays during the denoising can
+                    # overwrite it while the scheduler still reads it as the original images
+                    fea_cat = fea_cat.clone()
+                run_inference_step(to_anomaly_map, confusions, gts, i, fea_cat, model, noise_kind,
+                                   noise_scheduler_inference, states, writer, args.eta, args.num_inference_steps,
+                                   args.start_at_timestep, args.patch_imgs, args.plt_imgs, args.img_dir)
+
+        confusion = torch.cat(confusions)
+        if sampler is not None:
+            # the sampler repeats samples to give every process the same number of samples, drop the repetitions
+            confusion = confusion[:len(range(sampler.rank, len(test_data), sampler.num_replicas))]
+            confusion = gather_rows(confusion, sampler.num_samples)
+        eval_scores = scores_from_confusion(confusion)
+
+        if is_main_process():
+            writer.add_hparams({'category': args.mvtec_item, 'eta': args.eta,
+                                'recon_weight': args.reconstruction_weight, 'states': ','.join(args.mvtec_item_states),
+                                't': args.start_at_timestep, 'num_steps': args.num_inference_steps,
+                                'input_size': model_config["sample_size"], 'patching': args.patch_imgs}, eval_scores,
+                               run_name=f'hp')
+            print(eval_scores)
+
+
+def run_inference_step(to_anomaly_map, confusions, gts, btc_idx, imgs, model, noise_kind, noise_scheduler_inference,
                        states, writer, eta, num_inference_steps, start_at_timestep, patch_imgs, plt_imgs, img_dir):
     originals, reconstructions, diffmaps, history = generate_samples(model, noise_scheduler_inference,
                                                                      imgs,
                                                                      eta, num_inference_steps,
                                                                      start_at_timestep,
                                                                      patch_imgs,
-                                                                     noise_kind)
-    anomaly_maps = utils.anomalies.diff_map_to_anomaly_map(diffmaps, .3, diffmap_blur)
+                                                                     noise_kind,
+                                                                     # only read by the (disabled) writer code below
+                                                                     return_history=False)
+    # the post-processing runs on the device, a cpu input would keep the compiled module from using cuda graphs
+    diffmaps = diffmaps.to(gts.device)
+    anomaly_maps = to_anomaly_map(diffmaps)
+    # drop the samples that were only added to pad the batch to a static size
+    originals, reconstructions = originals[:len(gts)], reconstructions[:len(gts)]
+    diffmaps, anomaly_maps = diffmaps[:len(gts)], anomaly_maps[:len(gts)]
     # overlays = add_batch_overlay(originals, anomaly_maps)
-    eval_scores.update(scores_batch(gts, anomaly_maps))
+    confusions.append(confusion_batch(gts, anomaly_maps))
     for idx in range(len(gts)):
         if not os.path.exists(f"{img_dir}"):
             os.makedirs(f"{img_dir}")
@@ -190,7 +243,11 @@ def run_inference_step(diffmap_blur, eval_scores, gts, btc_idx, imgs, model, noi
 
 if __name__ == '__main__':
     args: InferenceArgs = parse_args()
-    writer = SummaryWriter(f'{args.log_dir}/{args.run_id}') if args.log_dir else None
+    args.device = setup_distributed(args.device)
+    writer = SummaryWriter(f'{args.log_dir}/{args.run_id}') if args.log_dir and is_main_process() else None
     main(args, writer)
-    writer.flush()
-    writer.close()
+    if writer is not None:
+        writer.flush()
+        writer.close()
+    if is_distributed():
+        dist.destroy_process_group()
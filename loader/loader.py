@@ -1,8 +1,8 @@
 import os
-from typing import List
+from typing import List, Union
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 from pathlib import Path
 from torchvision import transforms
@@ -13,6 +13,9 @@ class MVTecDataset(Dataset):
         self.transform = transform
         self.train = train
         self.imgs, self.ground_truths, self.obj_states, self.original_imgs = self._load_data(path, train, piece, states)
+        # the transform is only applied while loading, dropping it keeps the dataset picklable for worker processes
+        # (e.g. a local function holding augmentations on the gpu)
+        self.transform = None
 
     def __len__(self):
         return len(self.imgs)
@@ -72,3 +75,89 @@ class MVTecDataset(Dataset):
 
         return [augmentations(image) if image is not None else torch.zeros((3, target_size, target_size)) for image in imgs]
 
+
+def pin_worker_to_core(worker_id: int):
+    """
+    worker_init_fn for a DataLoader: pins each worker process to one of the cpu cores available to the main process,
+    so the workers are not moved between cores. Does nothing on platforms without sched_setaffinity (e.g. Windows).
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cores[worker_id % len(cores)]})
+
+
+class DeviceDataset(Dataset):
+    """
+    Keeps all items of a (small) dataset stacked on the device, so they only have to be copied once.
+    Indexing with a list of indices returns a whole batch, i.e. use it with a BatchSampler and batch_size=None.
+    Columns that are not tensors (e.g. the object states) are kept as lists.
+    """
+
+    def __init__(self, dataset: Dataset, device: str):
+        items = [dataset[idx] for idx in range(len(dataset))]
+        self.columns = [torch.stack(column).to(device) if isinstance(column[0], torch.Tensor) else list(column)
+                        for column in zip(*items)]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, idx: Union[int, List[int]]):
+        if isinstance(idx, int):
+            return tuple(column[idx] for column in self.columns)
+        return tuple(column[idx] if isinstance(column, torch.Tensor) else [column[i] for i in idx]
+                     for column in self.columns)
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader and copies the next batch to the device on a side stream while the current batch is processed.
+    Only the tensors of a batch are moved, other items (e.g. the object states) are passed through.
+    Image batches (4D tensors) are converted to the given memory format.
+    The wrapped loader should use pinned memory, otherwise the copies cannot run asynchronously.
+    """
+
+    def __init__(self, loader: DataLoader, device: str, memory_format: torch.memory_format = torch.preserve_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        prefetched = None
+        for batch in self.loader:
+            with torch.cuda.stream(stream):
+                batch = self._to_device(batch)
+                copied = torch.cuda.Event()
+                copied.record(stream)
+
+            if prefetched is not None:
+                yield self._wait_for(*prefetched)
+            prefetched = batch, copied
+
+        if prefetched is not None:
+            yield self._wait_for(*prefetched)
+
+    def _to_device(self, batch):
+        return [self._tensor_to_device(item) if isinstance(item, torch.Tensor) else item for item in batch]
+
+    def _tensor_to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        memory_format = self.memory_format if tensor.dim() == 4 else torch.preserve_format
+        return tensor.to(self.device, memory_format=memory_format, non_blocking=True)
+
+    def _wait_for(self, batch, copied):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(copied)
+        for item in batch:
+            if isinstance(item, torch.Tensor):
+                # the tensors were allocated on the side stream, but are used on the current one
+                item.record_stream(current_stream)
+        return batch
@@ -6,7 +6,7 @@ import argparse
 from collections import Counter
 
 import wandb
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 import torch
 from torchvision import transforms
 from torch.utils.tensorboard import SummaryWriter
@@ -17,15 +17,16 @@ from pipe.validate import validate_step
 from diffusers import DDPMScheduler, UNet2DModel, get_scheduler
 import diffusers
 from tqdm import tqdm
-from loader.loader import MVTecDataset
+from loader.loader import MVTecDataset, DeviceDataset, PrefetchLoader, pin_worker_to_core
 from utils.anomalies import diff_map_to_anomaly_map
+from utils.attention import set_sdpa_attention
+from utils.features import EfficientNetEndpoints, FeatureExtractor
 from utils.files import save_args
+from utils.transforms import batch_augmentations, transform_batch
 from utils.visualize import generate_samples, plot_single_channel_imgs, plot_rgb_imgs, gray_to_rgb
 from dataclasses import dataclass
 from schedulers.scheduling_ddim import DDIMScheduler
 from schedulers.scheduling_ddpm import DBADScheduler
-from efficientnet_pytorch import EfficientNet
-from torch.nn import functional as F
 
 @dataclass
 class TrainArgs:
@@ -43,11 +44,15 @@ class TrainArgs:
     reconstruction_weight: float
     eta: float
     batch_size: int
+    num_workers: int
     noise_kind: str
     plt_imgs: bool
     img_dir: str
     calc_val_loss: bool
     crop: bool
+    compile: bool
+    bf16: bool
+    extractor_dtype: str
 
 
 def parse_args() -> TrainArgs:
@@ -82,6 +87,8 @@ def parse_args() -> TrainArgs:
                         help='Stochasticity parameter of DDIM, with eta=1 being DDPM and eta=0 meaning no randomness. Only used during inference, not training.')
     parser.add_argument('--batch_size', type=int, default=64,
                         help='Batch size during training')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='Number of worker processes of the train loader. The images are preprocessed once when the dataset is created, so the workers only collate the batches.')
     parser.add_argument('--noise_kind', type=str, default="gaussian",
                         choices=["simplex", "gaussian"],
                         help='Kind of noise to use for the noising steps.')
@@ -91,44 +98,47 @@ def parse_args() -> TrainArgs:
                         help='If set: plot the images with matplotlib')
     parser.add_argument('--calc_val_loss', action='store_true',
                         help='If set: calculate not only the train loss, but also the validation loss during each epoch')
+    parser.add_argument('--compile', action='store_true',
+                        help='If set: compile the UNet and the feature extractor with torch.compile (CUDA graphs).')
+    parser.add_argument('--bf16', action='store_true',
+                        help='If set: run the feature extractor and the UNet forward pass with bfloat16 autocast.')
+    parser.add_argument('--extractor_dtype', type=str, default="float32",
+                        choices=["float32", "bfloat16", "float16"],
+                        help='Precision in which the weights of the (frozen) EfficientNet feature extractor are stored and run.')
     parser.add_argument('--img_dir', type=str, default=None,
                         help='Directory to store the images created during the run. A new directory with the run-id will be created in this directory. If not used images wont be stored except for tensorboard.')
 
     return TrainArgs(**vars(parser.parse_args()))
 
 
-def transform_imgs_test(imgs):
-    augmentations = transforms.Compose(
-        [
-            transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ]
-    )
-
-    return [augmentations(image.convert("RGB")) for image in imgs]
-
-
-def transform_imgs_train(imgs):
-    augmentations = transforms.Compose(
-        [
-            transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ]
-    )
-
-    return [augmentations(image.convert("RGB")) for image in imgs]
-
-
 def main(args: TrainArgs):
     # -------------      load data      ------------
+    # train and test images get the same augmentations, build them only once
+    augmentations = batch_augmentations(args.resolution).to(args.device)
+
+    def transform_images(imgs):
+        return transform_batch(imgs, augmentations, args.device)
+
     data_train = MVTecDataset(args.dataset_path, True, args.mvtec_item, ["good"],
-                              transform_imgs_train)
-    train_loader = DataLoader(data_train, batch_size=args.batch_size, shuffle=True, num_workers = 24)
+                              transform_images)
+    # with --compile a partial last batch has a second shape that needs its own compiled (cuda) graphs, drop it
+    # unless it is the only batch (e.g. toothbrush has fewer train images than the default batch size)
+    train_loader = PrefetchLoader(DataLoader(data_train, batch_size=args.batch_size, shuffle=True,
+                                             drop_last=args.compile and len(data_train) > args.batch_size,
+                                             num_workers=args.num_workers, pin_memory=True,
+                                             persistent_workers=args.num_workers > 0,
+                                             prefetch_factor=4 if args.num_workers > 0 else None,
+                                             worker_init_fn=pin_worker_to_core), args.device,
+                                  memory_format=torch.channels_last)
     test_data = MVTecDataset(args.dataset_path, False, 'bottle', ["all"],
-                             transform_imgs_test)
-    test_loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=False, num_workers = 24)
+                             transform_images)
+    # the test set is small, keep it on the device instead of copying it in every epoch
+    test_data = DeviceDataset(test_data, args.device)
+    # with --compile drop the partial last test batch too (unless it is the only batch), in eager mode the loss is
+    # computed on the whole test set
+    test_loader = DataLoader(test_data, batch_size=None,
+                             sampler=BatchSampler(SequentialSampler(test_data), args.batch_size,
+                                                  drop_last=args.compile and len(test_data) > args.batch_size))
 
     # ----------- set model, optimizer, scheduler -----------------
     channel_multiplier = {
@@ -153,7 +163,9 @@ def main(args: TrainArgs):
     model = UNet2DModel(
         **model_args
     )
-    feature_extractor = EfficientNet.from_pretrained('efficientnet-b4')
+    set_sdpa_attention(model)
+    feature_extractor = FeatureExtractor(EfficientNetEndpoints.from_pretrained('efficientnet-b4'),
+                                         dtype=getattr(torch, args.extractor_dtype))
     noise_scheduler = DDPMScheduler(args.train_steps, beta_schedule=args.beta_schedule)
     inf_noise_scheduler = DDIMScheduler(args.train_steps, 150,
                                         beta_schedule=args.beta_schedule, timestep_spacing="leading",
@@ -177,7 +189,7 @@ def main(args: TrainArgs):
 
     # additional info/util
     timestamp = str(time.time())[:11]
-    writer = SummaryWriter(f'{args.log_dir}/{args.run_name}_{timestamp}')
+    writer = SummaryWriter(f'{args.log_dir}/{args.run_name}_{timestamp}', flush_secs=120)
     diffmap_blur = transforms.GaussianBlur(2 * int(4 * 4 + 0.5) + 1, 4)
     run_id = f"{args.run_name}_{timestamp}"
     print(diffusers.utils.logging.is_progress_bar_enabled())
@@ -199,38 +211,48 @@ def main(args: TrainArgs):
     save_args(args, f"{args.checkpoint_dir}/{args.run_name}_{timestamp}", "train_arg_config")
     save_args(model_args, f"{args.checkpoint_dir}/{args.run_name}_{timestamp}", "model_config")
 
+    # the convolutions of EfficientNet and the UNet are faster in channels last
+    model.to(args.device, memory_format=torch.channels_last)
+    feature_extractor.to(args.device, memory_format=torch.channels_last)
+    feature_extractor.eval()
+    model.train()
+
+    # keep a reference to the uncompiled model, its state dict is the one stored in the checkpoints
+    train_model = model
+    extract_features = feature_extractor
+    if args.compile:
+        train_model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        extract_features = torch.compile(feature_extractor, mode="reduce-overhead", fullgraph=True, dynamic=False)
+    # in eager mode the features of every batch are written into the same buffer instead of a new torch.cat output,
+    # compiled graphs already write the resized endpoints into one (static) output
+    fea_buffer = None if args.compile else feature_extractor.empty_output(
+        args.batch_size, model_args["in_channels"], device=args.device, memory_format=torch.channels_last)
+
     for epoch in range(args.epochs):
-        model.train()
-        model.to(args.device)
-        feature_extractor.to(args.device)
-        feature_extractor.eval()
         progress_bar = tqdm(total=len(train_loader) + len(test_loader))
         progress_bar.set_description(f"Epoch {epoch}")
 
         running_loss_train = 0
 
         for btc_num, (batch, _) in enumerate(train_loader):
-            with torch.no_grad():
-                image_features = list(feature_extractor.extract_endpoints(batch.to(args.device)).values())[:-2]
-            for i in range(4):
-                image_features[i] = F.interpolate(image_features[i], size=(32, 32), mode='bilinear')
-            fea_cat = torch.cat(image_features, dim=1)
-            loss = train_step(model, fea_cat, noise_scheduler, lr_scheduler, loss_fn, optimizer, args.train_steps,
-                              args.noise_kind)
+            with torch.no_grad(), torch.autocast(device_type=batch.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                fea_out = None if fea_buffer is None else fea_buffer[:len(batch)]
+                fea_cat = extract_features(batch, fea_out).float().contiguous(memory_format=torch.channels_last)
+            loss = train_step(train_model, fea_cat, noise_scheduler, lr_scheduler, loss_fn, optimizer, args.train_steps,
+                              args.noise_kind, args.bf16)
 
             running_loss_train += loss
             progress_bar.update(1)
 
         running_loss_test = 0
+        model.eval()
         with torch.no_grad():
             scores = Counter()
             for _btc_num, (_batch, _labels, gts) in enumerate(test_loader):
-                loss = validate_step(model, _batch, noise_scheduler, args.train_steps,
+                loss = validate_step(train_model, _batch, noise_scheduler, args.train_steps,
                                      loss_fn) if args.calc_val_loss else 0
 
                 running_loss_test += loss
-
-                writer.add_scalars(main_tag='scores', tag_scalar_dict=dict(scores), global_step=epoch)
                 progress_bar.update(1)
 
             # if epoch % 100 == 0:
@@ -242,6 +264,7 @@ def main(args: TrainArgs):
 
             for key in scores:
                 scores[key] /= len(test_loader)
+            writer.add_scalars(main_tag='scores', tag_scalar_dict=dict(scores), global_step=epoch)
 
             progress_bar.set_postfix_str(
                 f"Train Loss: {running_loss_train / len(train_loader)}, Test Loss: {running_loss_test / len(test_loader)}, {dict(scores)}")
@@ -249,11 +272,12 @@ def main(args: TrainArgs):
 
             if epoch % args.save_n_epochs == 0 and epoch > 0:
                 torch.save(model.state_dict(), f"{args.checkpoint_dir}/{args.run_name}_{timestamp}/epoch_{epoch}.pt")
+                writer.flush()
+        model.train()
 
         writer.add_scalar('Loss/train', running_loss_train, epoch)
         writer.add_scalar('Loss/test', running_loss_test, epoch)
-        wandb.log({"loss_train": running_loss_train})
-        wandb.log({"loss_test": running_loss_test})
+        wandb.log({"loss_train": running_loss_train, "loss_test": running_loss_test}, step=epoch)
 
     writer.add_hparams({'category': args.mvtec_item, 'res': args.resolution, 'eta': args.eta,
                         'recon_weight': args.reconstruction_weight}, {'MSE': running_loss_test},
@@ -2,10 +2,10 @@ import torch
 from noise.simplex import simplexGenerator
 
 
-def train_step(model, batch, noise_scheduler, lr_scheduler, loss_fn, optimizer, num_train_steps, noise_kind='gaussian'):
+def train_step(model, batch, noise_scheduler, lr_scheduler, loss_fn, optimizer, num_train_steps, noise_kind='gaussian',
+               bf16=False):
     assert noise_kind in ['gaussian', 'simplex']
 
-    model.train()
     clean_imgs = batch.to(model.device)
 
     noise = None
@@ -20,9 +20,11 @@ def train_step(model, batch, noise_scheduler, lr_scheduler, loss_fn, optimizer,
 
     optimizer.zero_grad()
 
-    prediction = model(noisy_images, timesteps).sample
+    # bfloat16 has the exponent range of fp32, so unlike fp16 no gradient scaling is needed
+    with torch.autocast(device_type=clean_imgs.device.type, dtype=torch.bfloat16, enabled=bf16):
+        prediction = model(noisy_images, timesteps).sample
+        loss = loss_fn(prediction, noise)
 
-    loss = loss_fn(prediction, noise)
     loss.backward()
 
     optimizer.step()
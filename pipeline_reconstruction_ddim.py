@@ -56,6 +56,7 @@ class DDIMReconstructionPipeline(DiffusionPipeline):
             use_clipped_model_output: Optional[bool] = None,
             output_type: Optional[str] = "pil",
             return_dict: bool = True,
+            return_history: bool = True,
     ) -> Union[ImagePipelineOutput, Tuple]:
         r"""
         The call function to the pipeline for generation.
@@ -80,6 +81,9 @@ class DDIMReconstructionPipeline(DiffusionPipeline):
                 The output format of the generated image. Choose between `PIL.Image` or `np.array`.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.ImagePipelineOutput`] instead of a plain tuple.
+            return_history (`bool`, *optional*, defaults to `True`):
+                Whether or not to keep a copy of the image after every denoising step. Every copy synchronizes
+                with the device, disable it if the history is not used.
 
         Example:
 
@@ -140,9 +144,13 @@ class DDIMReconstructionPipeline(DiffusionPipeline):
         self.scheduler.set_timesteps(num_inference_steps, start_at_timestep)
         history = {'images': [], 'timesteps': []}
 
-        for t in self.progress_bar(self.scheduler.timesteps):
+        # the scheduler indexes its precomputed coefficients with the timesteps on the cpu, while the unet gets them
+        # on the device, this avoids a synchronization or a host to device copy in every step
+        unet_timesteps = self.scheduler.timesteps.to(self._execution_device)
+
+        for i, t in enumerate(self.progress_bar(self.scheduler.timesteps)):
             # 1. predict noise model_output
-            model_output = self.unet(image, t).sample
+            model_output = self.unet(image, unet_timesteps[i]).sample
 
             # 2. predict previous mean of image x_t-1 and add variance depending on eta
             # eta corresponds to η in paper and should be between [0, 1]
@@ -152,16 +160,21 @@ class DDIMReconstructionPipeline(DiffusionPipeline):
                 generator=generator
             ).prev_sample
 
-            image_cp = post_process_img(image, output_type, np_ordering=False)
-            history["images"].append(image_cp)
-            history["timesteps"].append(t)
+            if return_history:
+                # copy to pageable memory, a non-blocking copy would pin a new full batch on the host every step
+                history["images"].append(image.cpu())
+                history["timesteps"].append(t)
+
+        images = post_process_img(image, np_ordering=False)
+        history["images"] = [post_process_img(img, output_type, np_ordering=False) for img in history["images"]]
+        image_cp = history["images"][-1] if return_history else post_process_img(image, output_type, np_ordering=False)
 
         history["images"].reverse()
         history["timesteps"].reverse()
         if not return_dict:
             return image_cp, history
 
-        return DBADPipelineOutput(images=post_process_img(image, np_ordering=False), history=history)
+        return DBADPipelineOutput(images=images, history=history)
 
 
 def post_process_img(image, output_type="numpy", np_ordering=True):
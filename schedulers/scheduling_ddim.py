@@ -245,6 +245,7 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
         # setable values
         self.num_inference_steps = None
         self.timesteps = torch.from_numpy(np.arange(0, num_train_timesteps)[::-1].copy().astype(np.int64))
+        self.step_coefficients = None
 
     def scale_model_input(self, sample: torch.FloatTensor, timestep: Optional[int] = None) -> torch.FloatTensor:
         """
@@ -260,15 +261,36 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
         """
         return sample
 
-    def _get_variance(self, timestep, prev_timestep):
-        alpha_prod_t = self.alphas_cumprod[timestep]
-        alpha_prod_t_prev = self.alphas_cumprod[prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
-        beta_prod_t = 1 - alpha_prod_t
-        beta_prod_t_prev = 1 - alpha_prod_t_prev
-
-        variance = (beta_prod_t_prev / beta_prod_t) * (1 - alpha_prod_t / alpha_prod_t_prev)
+    def _compute_step_coefficients(self) -> torch.FloatTensor:
+        """
+        Computes the coefficients used in `step` for all timesteps at once, so that a step only has to index them
+        instead of recomputing them from `alphas_cumprod`.
 
-        return variance
+        Returns:
+            `torch.FloatTensor` of shape `(num_train_timesteps, 5)`: sqrt(alpha_prod_t), sqrt(beta_prod_t),
+            sqrt(alpha_prod_t_prev), beta_prod_t_prev and sqrt(variance) for every timestep.
+        """
+        timesteps = torch.arange(self.config.num_train_timesteps)
+        prev_timesteps = timesteps - self.config.start_at_timestep // self.num_inference_steps
+
+        alphas_cumprod = self.alphas_cumprod
+        alphas_cumprod_prev = torch.where(
+            prev_timesteps >= 0, alphas_cumprod[prev_timesteps.clamp(min=0)], self.final_alpha_cumprod
+        )
+        betas_cumprod = 1 - alphas_cumprod
+        betas_cumprod_prev = 1 - alphas_cumprod_prev
+        variances = (betas_cumprod_prev / betas_cumprod) * (1 - alphas_cumprod / alphas_cumprod_prev)
+
+        return torch.stack(
+            [alphas_cumprod**0.5, betas_cumprod**0.5, alphas_cumprod_prev**0.5, betas_cumprod_prev, variances**0.5],
+            dim=1,
+        )
+
+    def _get_step_coefficients(self, timestep: int, device: torch.device) -> Tuple[torch.FloatTensor, ...]:
+        # move the coefficients to the device of the samples once, afterwards they are only indexed
+        if self.step_coefficients.device != device:
+            self.step_coefficients = self.step_coefficients.to(device)
+        return self.step_coefficients[timestep].unbind()
 
     # Copied from diffusers.schedulers.scheduling_ddpm.DDPMScheduler._threshold_sample
     def _threshold_sample(self, sample: torch.FloatTensor) -> torch.FloatTensor:
@@ -330,7 +352,9 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
                 f" maximal {self.config.num_train_timesteps} timesteps."
             )
 
-        self.num_inference_steps = num_inference_steps
+        if num_inference_steps != self.num_inference_steps or self.step_coefficients is None:
+            self.num_inference_steps = num_inference_steps
+            self.step_coefficients = self._compute_step_coefficients()
 
         # "linspace", "leading", "trailing" corresponds to annotation of Table 2. of https://arxiv.org/abs/2305.08891
         if self.config.timestep_spacing == "linspace":
@@ -402,6 +426,8 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
                 "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
             )
         t = timestep
+        # the model output might be in reduced precision (autocast), keep the scheduler math in the dtype of the sample
+        model_output = model_output.to(sample.dtype)
 
         # See formulas (12) and (16) of DDIM paper https://arxiv.org/pdf/2010.02502.pdf
         # Ideally, read DDIM paper in-detail understanding
@@ -414,26 +440,27 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
         # - pred_sample_direction -> "direction pointing to x_t"
         # - pred_prev_sample -> "x_t-1"
 
-        # 1. get previous step value (=t-1)
-        prev_timestep = timestep - self.config.start_at_timestep // self.num_inference_steps
-
-        # 2. compute alphas, betas
-        alpha_prod_t = self.alphas_cumprod[timestep]
-        alpha_prod_t_prev = self.alphas_cumprod[prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
-
-        beta_prod_t = 1 - alpha_prod_t
+        # 1. & 2. get the alphas, betas (and the variance) of the current and the previous step (=t-1),
+        # they are precomputed for all timesteps in `set_timesteps`
+        (
+            sqrt_alpha_prod_t,
+            sqrt_beta_prod_t,
+            sqrt_alpha_prod_t_prev,
+            beta_prod_t_prev,
+            sqrt_variance,
+        ) = self._get_step_coefficients(timestep, sample.device)
 
         # 3. compute predicted original sample from predicted noise also called
         # "predicted x_0" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
         if self.config.prediction_type == "epsilon":
-            pred_original_sample = (sample - beta_prod_t ** (0.5) * model_output) / alpha_prod_t ** (0.5)
+            pred_original_sample = (sample - sqrt_beta_prod_t * model_output) / sqrt_alpha_prod_t
             pred_epsilon = model_output
         elif self.config.prediction_type == "sample":
             pred_original_sample = model_output
-            pred_epsilon = (sample - alpha_prod_t ** (0.5) * pred_original_sample) / beta_prod_t ** (0.5)
+            pred_epsilon = (sample - sqrt_alpha_prod_t * pred_original_sample) / sqrt_beta_prod_t
         elif self.config.prediction_type == "v_prediction":
-            pred_original_sample = (alpha_prod_t**0.5) * sample - (beta_prod_t**0.5) * model_output
-            pred_epsilon = (alpha_prod_t**0.5) * model_output + (beta_prod_t**0.5) * sample
+            pred_original_sample = sqrt_alpha_prod_t * sample - sqrt_beta_prod_t * model_output
+            pred_epsilon = sqrt_alpha_prod_t * model_output + sqrt_beta_prod_t * sample
         else:
             raise ValueError(
                 f"prediction_type given as {self.config.prediction_type} must be one of `epsilon`, `sample`, or"
@@ -450,18 +477,17 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
 
         # 5. compute variance: "sigma_t(η)" -> see formula (16)
         # σ_t = sqrt((1 − α_t−1)/(1 − α_t)) * sqrt(1 − α_t/α_t−1)
-        variance = self._get_variance(timestep, prev_timestep)
-        std_dev_t = eta * variance ** (0.5)
+        std_dev_t = eta * sqrt_variance
 
         if use_clipped_model_output:
             # the pred_epsilon is always re-derived from the clipped x_0 in Glide
-            pred_epsilon = (sample - alpha_prod_t ** (0.5) * pred_original_sample) / beta_prod_t ** (0.5)
+            pred_epsilon = (sample - sqrt_alpha_prod_t * pred_original_sample) / sqrt_beta_prod_t
 
         # 6. compute "direction pointing to x_t" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
-        pred_sample_direction = (1 - alpha_prod_t_prev - std_dev_t**2) ** (0.5) * pred_epsilon
+        pred_sample_direction = (beta_prod_t_prev - std_dev_t**2) ** (0.5) * pred_epsilon
 
         # 7. compute x_t without "random noise" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
-        prev_sample = alpha_prod_t_prev ** (0.5) * pred_original_sample + pred_sample_direction
+        prev_sample = sqrt_alpha_prod_t_prev * pred_original_sample + pred_sample_direction
 
         initial_coeff = t * self.reconstruction_weight / 1000
         if t < 0:
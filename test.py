@@ -176,7 +176,9 @@ def run_inference_step(diffmap_blur, eval_scores, gts, btc_idx, imgs, model, noi
                                                                      eta, num_inference_steps,
                                                                      start_at_timestep,
                                                                      patch_imgs,
-                                                                     noise_kind)
+                                                                     noise_kind,
+                                                                     # only read by the (disabled) writer code below
+                                                                     return_history=False)
     anomaly_maps = utils.anomalies.diff_map_to_anomaly_map(diffmaps, .3, diffmap_blur)
     # overlays = add_batch_overlay(originals, anomaly_maps)
     eval_scores.update(scores_batch(gts, anomaly_maps))
@@ -1,9 +1,39 @@
 import torch
 from torch import Tensor
 from torch.nn import Module
+from torch.nn import functional as F
 
 
 def diff_map_to_anomaly_map(diff_map: Tensor, threshold: float, transform: Module = None) -> Tensor:
     if transform is not None:
         diff_map = transform(diff_map)
     return torch.where(diff_map >= threshold, 1, 0)
+
+
+class AnomalyMap(Module):
+    """
+    Same as diff_map_to_anomaly_map with a transforms.GaussianBlur as transform, but the blur is split into two
+    1D convolutions with precomputed kernels. This way the whole post-processing can be compiled into few kernels.
+    The input is expected on the device of the module. The blur always runs in fp32, so an active autocast does not
+    change which pixels pass the threshold.
+    """
+
+    def __init__(self, threshold: float, kernel_size: int = 33, sigma: float = 4.):
+        super().__init__()
+        self.threshold = threshold
+        half = kernel_size // 2
+        kernel = torch.exp(-0.5 * (torch.linspace(-half, half, kernel_size) / sigma) ** 2)
+        kernel = kernel / kernel.sum()
+        self.register_buffer("kx", kernel.reshape(1, 1, 1, -1))
+        self.register_buffer("ky", kernel.reshape(1, 1, -1, 1))
+
+    def forward(self, diff_map: Tensor) -> Tensor:
+        with torch.autocast(diff_map.device.type, enabled=False):
+            diff_map = diff_map.float()
+            channels = diff_map.shape[1]
+            pad = self.kx.shape[-1] // 2
+            # reflect padding, like torchvision's gaussian blur
+            diff_map = F.pad(diff_map, [pad, pad, pad, pad], mode="reflect")
+            diff_map = F.conv2d(diff_map, self.kx.expand(channels, -1, -1, -1), groups=channels)
+            diff_map = F.conv2d(diff_map, self.ky.expand(channels, -1, -1, -1), groups=channels)
+            return torch.where(diff_map >= self.threshold, 1, 0)
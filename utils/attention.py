@@ -0,0 +1,18 @@
+from diffusers.models.attention_processor import Attention, AttnProcessor2_0
+from torch.nn import Module
+
+
+def set_sdpa_attention(model: Module) -> Module:
+    """
+    Explicitly route all attention layers of a diffusers model (e.g. in AttnDownBlock2D/AttnUpBlock2D) through
+    torch.nn.functional.scaled_dot_product_attention. This is already the default for PyTorch >= 2.0, setting it
+    makes sure a loaded model does not fall back to another processor.
+
+    :param model: diffusers model, e.g. a UNet2DModel
+    :return: the same model
+    """
+
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.set_processor(AttnProcessor2_0())
+    return model
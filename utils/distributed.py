@@ -0,0 +1,57 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch import Tensor
+
+
+def setup_distributed(device: str) -> str:
+    """
+    Initialize the default process group if the script was launched with torchrun (i.e. WORLD_SIZE > 1).
+    Every process then works on the GPU of its local rank.
+
+    :param device: device to use if the script does not run distributed
+    :return: device of this process
+    """
+
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return device
+
+    dist.init_process_group(backend="nccl")
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    return f"cuda:{local_rank}"
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process() -> bool:
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def gather_rows(rows: Tensor, max_rows: int) -> Tensor:
+    """
+    Concatenate the rows of a tensor from all processes, ordered by rank. The number of rows may differ between the
+    processes.
+
+    :param rows: rows of this process
+    :param max_rows: maximal number of rows of any process
+    :return: rows of all processes, or just the given rows if not running distributed
+    """
+
+    if not is_distributed():
+        return rows
+
+    world_size = dist.get_world_size()
+    num_rows = torch.tensor([len(rows)], device=rows.device)
+    all_num_rows = [torch.empty_like(num_rows) for _ in range(world_size)]
+    dist.all_gather(all_num_rows, num_rows)
+
+    padded = rows.new_zeros((max_rows, *rows.shape[1:]))
+    padded[:len(rows)] = rows
+    all_rows = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(all_rows, padded)
+
+    return torch.cat([r[:n.item()] for r, n in zip(all_rows, all_num_rows)])
@@ -0,0 +1,85 @@
+from typing import Dict, Optional
+
+import torch
+from efficientnet_pytorch import EfficientNet
+from torch import Tensor
+from torch.nn import Module
+from torch.nn import functional as F
+
+
+class EfficientNetEndpoints(EfficientNet):
+    """
+    EfficientNet that can stop the forward pass as soon as the requested number of endpoints is extracted.
+    The remaining (and widest) blocks as well as the head are then skipped.
+    """
+
+    def extract_endpoints(self, inputs: Tensor, num_endpoints: Optional[int] = None) -> Dict[str, Tensor]:
+        if num_endpoints is None:
+            return super().extract_endpoints(inputs)
+
+        endpoints = dict()
+
+        # Stem
+        x = self._swish(self._bn0(self._conv_stem(inputs)))
+        prev_x = x
+
+        # Blocks, same as EfficientNet.extract_endpoints until enough endpoints are collected
+        for idx, block in enumerate(self._blocks):
+            drop_connect_rate = self._global_params.drop_connect_rate
+            if drop_connect_rate:
+                drop_connect_rate *= float(idx) / len(self._blocks)
+            x = block(x, drop_connect_rate=drop_connect_rate)
+            if prev_x.size(2) > x.size(2):
+                endpoints['reduction_{}'.format(len(endpoints) + 1)] = prev_x
+            elif idx == len(self._blocks) - 1:
+                endpoints['reduction_{}'.format(len(endpoints) + 1)] = x
+            if len(endpoints) == num_endpoints:
+                return endpoints
+            prev_x = x
+
+        # Head
+        x = self._swish(self._bn1(self._conv_head(x)))
+        endpoints['reduction_{}'.format(len(endpoints) + 1)] = x
+
+        return endpoints
+
+
+class FeatureExtractor(Module):
+    """
+    Wraps an EfficientNetEndpoints backbone and creates the input of the diffusion model: the first endpoints of the
+    backbone, resized to a common resolution and concatenated along the channel dimension.
+    Keeping extraction, resizing and concatenation in one module allows torch.compile to fuse them into one graph.
+    The backbone is only used for inference, so it is frozen and can be stored in a reduced precision (dtype).
+    """
+
+    def __init__(self, backbone: EfficientNetEndpoints, size: int = 32, num_endpoints: int = 4,
+                 dtype: torch.dtype = torch.float32):
+        super().__init__()
+        self.backbone = backbone.requires_grad_(False).to(dtype)
+        self.size = size
+        self.num_endpoints = num_endpoints
+        self.dtype = dtype
+
+    def empty_output(self, batch_size: int, channels: int, **kwargs) -> Tensor:
+        """
+        Allocate a tensor that can hold the features of a whole batch, see `out` of forward.
+
+        :param batch_size: maximal number of images per batch
+        :param channels: total number of channels of the extracted endpoints
+        :param kwargs: passed to torch.empty, e.g. device or memory_format
+        :return: uninitialized tensor of shape (batch_size, channels, size, size)
+        """
+
+        return torch.empty((batch_size, channels, self.size, self.size), **kwargs)
+
+    def forward(self, imgs: Tensor, out: Optional[Tensor] = None) -> Tensor:
+        """
+        :param imgs: batch of normalized images
+        :param out: optional pre-allocated tensor the features are written to, e.g. a buffer that is reused for every
+            batch in eager mode. Its dtype may differ from the backbone dtype.
+        :return: concatenated features of shape (B, channels, size, size)
+        """
+
+        endpoints = self.backbone.extract_endpoints(imgs.to(self.dtype), self.num_endpoints).values()
+        resized = [F.interpolate(fea, size=(self.size, self.size), mode='bilinear') for fea in endpoints]
+        return torch.cat(resized, dim=1, out=out)
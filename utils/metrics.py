@@ -1,5 +1,3 @@
-from collections import Counter
-
 from torch import Tensor
 from typing import Dict
 import torch
@@ -20,15 +18,61 @@ def pro(gt: Tensor, prediction: Tensor) -> float:
     return 0
 
 
-def scores_batch(gts: Tensor, predictions: Tensor) -> Dict[str, float]:
-    batch_score = Counter()
+def confusion_batch(gts: Tensor, predictions: Tensor) -> Tensor:
+    """
+    Count the pixel-wise confusion of each image in a batch. Everything stays on the device, i.e. no synchronization
+    with the host is needed, so the counts can be collected over a whole dataset before calculating any metric.
+
+    :param gts: Batch of ground truth segmentation images
+    :param predictions: Batch of predicted anomaly regions images
+    :return: tensor of shape (B, 6) with tp, tn, fp, fn, ground truth max and prediction max for each image
+    """
+
+    gts_int = gts.flatten(1).int()
+    predictions_int = predictions.flatten(1).int()
+    _true = gts_int == predictions_int
+
+    return torch.stack([
+        torch.logical_and(_true, gts_int == 1).sum(1),
+        torch.logical_and(_true, gts_int == 0).sum(1),
+        (gts_int < predictions_int).sum(1),
+        (gts_int > predictions_int).sum(1),
+        gts.flatten(1).amax(1),
+        predictions.flatten(1).amax(1),
+    ], dim=1).double()
+
+
+def scores_from_confusion(confusion: Tensor) -> Dict[str, float]:
+    """
+    Calculate the metrics of @scores for each image from its confusion counts (see @confusion_batch) and average them
+    over all images. Only the averages are copied to the host.
+
+    :param confusion: confusion counts of shape (N, 6)
+    :return: dict with the averaged metrics
+    """
+
+    tp, tn, fp, fn, gt_max, prediction_max = confusion.unbind(1)
+    ones = torch.ones_like(tp)
+    zeros = torch.zeros_like(tp)
 
-    for gt, pred in zip(gts, predictions):
-        batch_score.update(scores(gt, pred))
+    metrics = {
+        'tpr': torch.where(tp + fn > 0, tp / (tp + fn), ones),
+        'fnr': torch.where(tp + fn > 0, fn / (fn + tp), zeros),
+        'fpr': fp / (tn + fp),
+        'tnr': tn / (tn + fp),
+        'acc': (tp + tn) / (tp + tn + fp + fn),
+        'precision': torch.where(tp + fp > 0, tp / (tp + fp), ones),
+        'f1': torch.where(tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), ones),
+        'img_acc': torch.logical_or(torch.logical_and(gt_max == 0, prediction_max == 0),
+                                    torch.logical_and(gt_max == 1, prediction_max == 1)).double()
+    }
+    means = torch.stack(list(metrics.values())).mean(1).tolist()
 
-    for key in batch_score:
-        batch_score[key] /= len(gts)
-    return dict(batch_score)
+    return dict(zip(metrics.keys(), means))
+
+
+def scores_batch(gts: Tensor, predictions: Tensor) -> Dict[str, float]:
+    return scores_from_confusion(confusion_batch(gts, predictions))
 
 
 def scores(gt: Tensor, prediction: Tensor) -> Dict[str, float]:
@@ -40,24 +84,4 @@ def scores(gt: Tensor, prediction: Tensor) -> Dict[str, float]:
     :return: dict with metrics
     """
 
-    num_pixels = gt.shape[-1] ** 2
-    _true = gt.squeeze().int() == prediction.squeeze().int()
-    tp = len(torch.argwhere(torch.logical_and(_true, gt.squeeze().int() == 1)))
-    tn = len(torch.argwhere(torch.logical_and(_true, gt.squeeze().int() == 0)))
-    fp = len(torch.argwhere(gt.squeeze().int() < prediction.squeeze().int()))
-    fn = len(torch.argwhere(gt.squeeze().int() > prediction.squeeze().int()))
-
-    return {
-        # 'tp': tp,
-        # 'tn': tn,
-        # 'fp': fp,
-        # 'fn': fn,
-        'tpr': tp / (tp + fn) if tp + fn > 0 else 1,
-        'fnr': fn / (fn + tp) if tp + fn > 0 else 0,
-        'fpr': fp / (tn + fp),
-        'tnr': tn / (tn + fp),
-        'acc': (tp + tn) / num_pixels,
-        'precision': tp / (tp + fp) if tp + fp > 0 else 1,
-        'f1': 2 * tp / (2 * tp + fp + fn) if (tp + fp + fn) > 0 else 1,
-        'img_acc': 1 if gt.max() == 0 and prediction.max() == 0 or gt.max() == 1 and prediction.max() == 1 else 0
-    }
+    return scores_batch(gt.unsqueeze(0), prediction.unsqueeze(0))
@@ -0,0 +1,61 @@
+from typing import List, Optional
+
+import torch
+from PIL.Image import Image
+from torch import Tensor
+from torch.nn import Module, Sequential, Identity
+from torchvision import transforms
+import torchvision.transforms.functional as F
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class ImageNormalize(Module):
+    """
+    Normalize a batch of images channel-wise. Mean and std are registered as buffers, so they are moved to the device
+    once together with the module instead of being re-created for every batch.
+    """
+
+    def __init__(self, mean: List[float], std: List[float]):
+        super().__init__()
+        self.register_buffer("mean", torch.tensor(mean).reshape(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).reshape(1, -1, 1, 1))
+
+    def forward(self, imgs: Tensor) -> Tensor:
+        return (imgs - self.mean) / self.std
+
+
+def batch_augmentations(resolution: Optional[int]) -> Sequential:
+    """
+    Create the augmentations that run on batches of uint8 image tensors (B, CH, H, W) on the device.
+
+    :param resolution: size to resize the images to. If None the images keep their size.
+    :return: module with the augmentations
+    """
+
+    return Sequential(
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True)
+        if resolution is not None else Identity(),
+        ImageNormalize(IMAGENET_MEAN, IMAGENET_STD),
+    )
+
+
+def transform_batch(imgs: List[Image], augmentations: Module, device: str, chunk_size: int = 32) -> Tensor:
+    """
+    Decode the images to uint8 tensors on the cpu and apply the augmentations chunk-wise on the device.
+
+    :param imgs: list of PIL images, all of them need to have the same size
+    :param augmentations: batch augmentations, see @batch_augmentations
+    :param device: device to run the augmentations on
+    :param chunk_size: number of images that are moved to the device at once
+    :return: tensor with the transformed images on the cpu, shape: (B, CH, H, W)
+    """
+
+    transformed = []
+    for idx in range(0, len(imgs), chunk_size):
+        batch = torch.stack([F.pil_to_tensor(image.convert("RGB")) for image in imgs[idx:idx + chunk_size]])
+        transformed.append(augmentations(batch.to(device, non_blocking=True)).cpu())
+
+    return torch.cat(transformed)
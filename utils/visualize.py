@@ -12,7 +12,7 @@ from pipeline_reconstruction_ddim import DDIMReconstructionPipeline
 
 
 
-def generate_samples(model, noise_scheduler, original_images, eta, steps_to_regenerate, start_at_timestep, patch_imgs=False, noise_kind='gaussian'):
+def generate_samples(model, noise_scheduler, original_images, eta, steps_to_regenerate, start_at_timestep, patch_imgs=False, noise_kind='gaussian', return_history=True):
     num_imgs = len(original_images)
     if patch_imgs:
         original_images = split_batch_into_patch(original_images, model.sample_size)
@@ -33,6 +33,7 @@ def generate_samples(model, noise_scheduler, original_images, eta, steps_to_rege
         eta=eta,
         start_at_timestep=start_at_timestep,
         output_type="numpy",
+        return_history=return_history,
     )
     reconstruction = pipe_output.images
     history = pipe_output.history